@@ -0,0 +1,419 @@
+"""
+Measure the cost of loading and searching the character table.
+
+Run `python benchmark.py` from the extension directory. Memory figures are
+the resident set size of a fresh interpreter before and after loading, each
+loader being measured in its own process.
+"""
+import sys
+import timeit
+import argparse
+import subprocess
+
+import character_table
+
+
+class LegacyUnicodeChar:
+    """ The per-row container object the extension used before the column store
+    """
+
+    def __init__(self, name, comment, block, code):
+        self.name = name if name != '<control>' else comment
+        self.comment = comment
+        self.block = block
+        self.code = code
+        self.character = chr(int(code, 16))
+
+    def get_search_name(self):
+        return ' '.join([self.character, self.code, self.name, self.comment])
+
+
+def load_legacy():
+    """ The original `_load_character_table`: one object per line of the text table
+    """
+    character_list = []
+    with open(character_table.TABLE_FILE, "r") as f:
+        for line in f.readlines():
+            name, comment, code, block = line.strip().split("\t")
+            character_list.append(LegacyUnicodeChar(name, comment, block, code))
+    return character_list
+
+
+def load_mapped():
+    return character_table.load_character_table(".")
+
+
+def load_columns():
+    with open(character_table.TABLE_FILE, "rb") as f:
+        rows = character_table.parse_table(f.read().decode("utf-8"))
+    return character_table.CharacterTable(dict(character_table.pack_table(rows)))
+
+
+BENCHMARK_QUERIES = [
+    "arrow",
+    "left arrow",
+    "snowman",
+    "degree",
+    "latin small letter e",
+    "lrarr",
+    "ightwa",
+]
+
+LOADERS = {
+    "legacy": load_legacy,
+    "mapped": load_mapped,
+    "columns": load_columns,
+}
+
+
+def rss_kb():
+    """ Resident set size of this process in kB (Linux only)
+    """
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+
+
+def measure_rss(loader):
+    """ Load the table in this process and print the RSS before and after
+    """
+    before = rss_kb()
+    table = LOADERS[loader]()
+    print(before, rss_kb(), len(table))
+
+
+def report_rss():
+    character_table.build_snapshot(".")
+    print("RSS of _load_character_table (kB)")
+    print("%-10s %10s %10s %10s" % ("loader", "before", "after", "delta"))
+    for loader in sorted(LOADERS):
+        output = subprocess.check_output([sys.executable, __file__, "--rss", loader])
+        before, after, _ = [int(value) for value in output.split()]
+        print("%-10s %10d %10d %10d" % (loader, before, after, after - before))
+
+
+def report_search_keys(repeat=20):
+    """ Time fetching the search string of every row, which a full table scan
+    does once per keystroke before scoring anything.
+    """
+    legacy = load_legacy()
+    table = load_mapped()
+
+    def legacy_scan():
+        for char in legacy:
+            char.get_search_name()
+
+    def key_scan():
+        for key in table.search_keys:
+            pass
+
+    print("Search strings of all %d rows, per keystroke (ms)" % len(table))
+    for label, scan in (
+        ("join per row", legacy_scan),
+        ("key column", key_scan),
+    ):
+        best = min(timeit.repeat(scan, number=1, repeat=repeat))
+        print("%-14s %8.2f" % (label, best * 1000))
+
+
+def report_matchers(repeat=5):
+    """ Time a full table scan with `ulauncher.search.SortedList` against
+    `matcher.top_matches`, and check that both rank the same rows.
+    """
+    try:
+        from ulauncher.search.SortedList import SortedList
+        import matcher
+    except ImportError:
+        print("ulauncher is not importable, skipping the matcher benchmark")
+        return
+    table = load_mapped()
+
+    print("Full scan of %d rows, top 10 (ms)" % len(table))
+    print("%-24s %10s %10s %5s" % ("query", "SortedList", "heap", "same"))
+    for query in BENCHMARK_QUERIES:
+
+        def sorted_list():
+            # A fresh view per row, as the extension fed the table to `SortedList`.
+            # It sets `score` on the views it keeps, hence their `score` slot.
+            result_list = SortedList(query, min_score=99, limit=10)
+            result_list.extend(table)
+            return [char.index for char in result_list]
+
+        def heap():
+            return matcher.top_matches(query, table.search_keys)
+
+        same = sorted_list() == heap()
+        sorted_list_time = min(timeit.repeat(sorted_list, number=1, repeat=repeat))
+        heap_time = min(timeit.repeat(heap, number=1, repeat=repeat))
+        print("%-24s %10.1f %10.1f %5s" % (
+            query, sorted_list_time * 1000, heap_time * 1000, "yes" if same else "NO"
+        ))
+
+
+def report_search_path(repeat=3):
+    """ Time the whole search of the extension for each benchmark query, and
+    show which stage answered it: the entity or abbreviation index, the rows
+    with the words of the query, the rows with its trigrams, or the full table
+    scan when the candidates of the indexes all fail fuzzy scoring.
+    """
+    try:
+        import main as extension
+        import matcher
+        from search_index import (
+            TOKEN_STAGE, TRIGRAM_STAGE, QueryRefiner, normalize_query, query_terms
+        )
+    except ImportError as e:
+        print("Skipping the search path benchmark: %s" % e)
+        return
+
+    table = load_mapped()
+    engine = matcher.create_matcher(table.search_keys, key_masks=table.key_masks)
+    stage_names = ["words", "trigrams"]
+
+    def answered_by(query):
+        query = normalize_query(query)
+        if table.entity_index.candidates(query):
+            return "entity", 0
+        if table.abbreviation_index.candidates(table, query):
+            return "abbreviation", 0
+        scored = 0
+        for stage, candidates in enumerate(QueryRefiner().candidate_rows(table, query)):
+            if not candidates:
+                continue
+            scored += len(candidates)
+            if stage == TOKEN_STAGE:
+                rows = table.token_index.rank(candidates, query_terms(query))
+            else:
+                rows = engine.top_matches(query, candidates)
+            if not rows and stage == TRIGRAM_STAGE and " " not in query:
+                rows = [row for row in candidates if query in table.search_keys[row]]
+                scored += len(rows)
+            if rows:
+                return stage_names[stage], scored
+        return "full scan", scored + len(table)
+
+    print("Whole search of a fresh query, top 10 (ms)")
+    print("%-24s %-14s %8s %10s" % ("query", "answered by", "scored", "ms"))
+    for query in BENCHMARK_QUERIES:
+        elapsed = min(timeit.repeat(
+            lambda: extension.search_characters(table, engine, query, QueryRefiner()),
+            number=1, repeat=repeat,
+        ))
+        stage, scored = answered_by(query)
+        print("%-24s %-14s %8d %10.1f" % (query, stage, scored, elapsed * 1000))
+
+
+# Queries whose results once depended on the queries typed before them
+INCREMENTAL_QUERIES = BENCHMARK_QUERIES + [
+    "left arrow 2",
+    "greek small letter a",
+    "u umlaut",
+]
+
+
+def report_incremental():
+    """ Check that typing each query one keystroke at a time, which refines
+    the candidates of the previous keystroke, finds the same results as
+    searching for the whole query at once.
+    """
+    try:
+        import main as extension
+        import matcher
+        from search_index import QueryRefiner
+    except ImportError as e:
+        print("Skipping the incremental search check: %s" % e)
+        return
+
+    table = load_mapped()
+    engine = matcher.create_matcher(table.search_keys, key_masks=table.key_masks)
+    print("Typed one keystroke at a time against a fresh search")
+    print("%-24s %5s" % ("query", "same"))
+    for query in INCREMENTAL_QUERIES:
+        refiner = QueryRefiner()
+        for end in range(1, len(query) + 1):
+            typed = extension.search_characters(table, engine, query[:end], refiner)
+        fresh = extension.search_characters(table, engine, query, QueryRefiner())
+        same = [char.index for char in typed] == [char.index for char in fresh]
+        print("%-24s %5s" % (query, "yes" if same else "NO"))
+
+
+def report_engines(repeat=5):
+    """ Time the pure Python matcher against the NumPy one over the whole table
+    """
+    try:
+        import matcher
+    except ImportError as e:
+        print("Skipping the matcher engine benchmark: %s" % e)
+        return
+    if matcher.numpy is None:
+        print("Skipping the matcher engine benchmark: NumPy is not installed")
+        return
+    table = load_mapped()
+    engines = [
+        ("python", matcher.create_matcher(table.search_keys, "python")),
+        ("numpy", matcher.create_matcher(
+            table.search_keys, "numpy", key_masks=table.key_masks
+        )),
+    ]
+
+    print("Matcher engines, full scan of %d rows, top 10 (ms)" % len(table))
+    print("%-24s %10s %10s %5s" % ("query", "python", "numpy", "same"))
+    for query in BENCHMARK_QUERIES:
+        results = [engine.top_matches(query) for name, engine in engines]
+        times = [
+            min(timeit.repeat(lambda: engine.top_matches(query), number=1, repeat=repeat))
+            for name, engine in engines
+        ]
+        print("%-24s %10.1f %10.1f %5s" % (
+            query, times[0] * 1000, times[1] * 1000, "yes" if results[0] == results[1] else "NO"
+        ))
+
+
+def report_shards(worker_counts=(1, 2, 4), repeat=3):
+    """ Time the benchmark queries against the whole table for each number of
+    worker processes of `matcher.ShardedMatcher`, compared to no workers.
+    """
+    try:
+        import matcher
+    except ImportError as e:
+        print("Skipping the sharded matcher benchmark: %s" % e)
+        return
+    table = load_mapped()
+
+    def run(engine):
+        return [engine.top_matches(query) for query in BENCHMARK_QUERIES]
+
+    local = matcher.create_matcher(table.search_keys, key_masks=table.key_masks)
+    expected = run(local)
+    baseline = min(timeit.repeat(lambda: run(local), number=1, repeat=repeat))
+    print("Sharded matching, all benchmark queries over %d rows" % len(table))
+    print("%-8s %10s %8s %5s" % ("workers", "ms", "speedup", "same"))
+    print("%-8d %10.1f %8.2f %5s" % (0, baseline * 1000, 1.0, "yes"))
+    for workers in worker_counts:
+        sharded = matcher.create_matcher(
+            table.search_keys, workers=workers, key_masks=table.key_masks
+        )
+        try:
+            same = run(sharded) == expected
+            elapsed = min(timeit.repeat(lambda: run(sharded), number=1, repeat=repeat))
+        finally:
+            sharded.close()
+        print("%-8d %10.1f %8.2f %5s" % (
+            workers, elapsed * 1000, baseline / elapsed, "yes" if same else "NO"
+        ))
+
+
+def report_ranking(repeat=5):
+    """ Time ranking the rows that have the words of each benchmark query by
+    their BM25 weights against fuzzy scoring the same rows.
+    """
+    try:
+        import matcher
+    except ImportError as e:
+        print("Skipping the ranking benchmark: %s" % e)
+        return
+    from search_index import query_terms
+
+    table = load_mapped()
+    engine = matcher.create_matcher(table.search_keys, key_masks=table.key_masks)
+    print("Ranking the rows with the words of the query, top 10 (ms)")
+    print("%-24s %8s %10s %10s" % ("query", "rows", "fuzzy", "bm25"))
+    for query in BENCHMARK_QUERIES:
+        terms = query_terms(query)
+        rows = table.token_index.candidates(terms)
+        if not rows:
+            continue
+
+        def fuzzy():
+            return engine.top_matches(query, rows)
+
+        def bm25():
+            return table.token_index.rank(rows, terms)
+
+        times = [min(timeit.repeat(rank, number=1, repeat=repeat)) for rank in (fuzzy, bm25)]
+        print("%-24s %8d %10.1f %10.1f" % (query, len(rows), times[0] * 1000, times[1] * 1000))
+
+
+def report_profiles(repeat=3):
+    """ Time a full scan with every benchmark query against the table of each
+    dataset profile
+    """
+    try:
+        import matcher
+    except ImportError as e:
+        print("Skipping the profile benchmark: %s" % e)
+        return
+    print("Full scan of all benchmark queries per profile")
+    print("%-12s %8s %10s" % ("profile", "rows", "ms"))
+    for profile in sorted(character_table.PROFILES):
+        table = character_table.load_character_table(".", profile)
+        engine = matcher.create_matcher(table.search_keys, key_masks=table.key_masks)
+
+        def run():
+            return [engine.top_matches(query) for query in BENCHMARK_QUERIES]
+
+        elapsed = min(timeit.repeat(run, number=1, repeat=repeat))
+        print("%-12s %8d %10.1f" % (profile, len(table), elapsed * 1000))
+
+
+def report_debounce():
+    """ Type each benchmark query one keystroke at a time through the search
+    of the extension, and print the query time percentiles and the debounce
+    `query_latency.QueryLatency` chooses for them.
+    """
+    try:
+        import main as extension
+        import matcher
+        from search_index import QueryRefiner
+    except ImportError as e:
+        print("Skipping the query latency benchmark: %s" % e)
+        return
+    from query_latency import QueryLatency
+
+    table = load_mapped()
+    engine = matcher.create_matcher(table.search_keys, key_masks=table.key_masks)
+    refiner = QueryRefiner()
+    latency = QueryLatency(window=1000)
+    for query in BENCHMARK_QUERIES:
+        for end in range(1, len(query) + 1):
+            start = timeit.default_timer()
+            extension.search_characters(table, engine, query[:end], refiner)
+            latency.record(timeit.default_timer() - start)
+    print("Query latency over %d keystrokes" % len(latency))
+    print("%-8s %10s" % ("", "ms"))
+    for label, fraction in (("p50", 0.5), ("p95", 0.95), ("max", 1.0)):
+        print("%-8s %10.1f" % (label, latency.percentile(fraction) * 1000))
+    print("%-8s %10.1f" % ("debounce", latency.debounce() * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rss", choices=sorted(LOADERS), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.rss:
+        measure_rss(args.rss)
+        return
+    report_rss()
+    print("")
+    report_search_keys()
+    print("")
+    report_matchers()
+    print("")
+    report_search_path()
+    print("")
+    report_incremental()
+    print("")
+    report_engines()
+    print("")
+    report_shards()
+    print("")
+    report_ranking()
+    print("")
+    report_profiles()
+    print("")
+    report_debounce()
+
+
+if __name__ == "__main__":
+    main()
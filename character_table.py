@@ -0,0 +1,498 @@
+"""
+Load the character table used by the extension.
+
+`generate_character_list.py` writes the table twice: as the tab separated text
+file `unicode_list.txt` and as a binary snapshot `unicode_list.bin` holding the
+same rows as packed columns. The snapshot is memory mapped and rows are only
+decoded when they are needed, so loading it costs page faults rather than
+building an object per character. The text file stays the source of truth:
+the snapshot records the size and modification time of the text file it was
+built from and is ignored when they do not match.
+
+A profile leaves rows of the text table out of the snapshot, e.g. the
+controls or everything but symbols, so that searching it costs less. Each
+profile has its own snapshot, which is built from the same text table.
+"""
+import os
+import re
+import sys
+import mmap
+import struct
+import logging
+import unicodedata
+from array import array
+from os.path import join
+from html.entities import codepoint2name, html5
+
+from search_index import (
+    AbbreviationIndex, EntityIndex, TokenIndex, TrigramIndex, fold, initials,
+    pack_abbreviation_index, pack_entity_index, pack_key_masks, pack_token_index,
+    pack_trigram_index, row_terms
+)
+
+logger = logging.getLogger(__name__)
+
+TABLE_FILE = "unicode_list.txt"
+SNAPSHOT_FILE = "unicode_list.bin"
+
+DEFAULT_PROFILE = "full"
+
+# Bump whenever the layout or the meaning of a snapshot section, or the rows a
+# profile keeps, change, so that older snapshots are rebuilt instead of misread.
+SNAPSHOT_VERSION = 12
+SNAPSHOT_MAGIC = b"USYM"
+
+# magic, format version, number of sections, size and modification time in
+# nanoseconds of the source text file. Its 24 bytes and the 16 of each section
+# entry are multiples of 8, so that the sections after them can be aligned.
+_HEADER = struct.Struct("<4sHHI4xq")
+# section tag, array typecode (or "B" for raw bytes), offset from file start, length in bytes
+_SECTION = struct.Struct("<4sc3xII")
+
+
+class UnicodeChar(object):
+    """ View of one row of a `CharacterTable`. Fields are read from the
+    table's columns on access, so a view is just a table and a row index,
+    plus the `score` that `ulauncher.search.SortedList` sets on its matches.
+    """
+
+    __slots__ = ("table", "index", "score")
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+        self.score = 0
+
+    @property
+    def name(self):
+        name = self.table.raw_name(self.index)
+        return name if name != '<control>' else self.comment
+
+    @property
+    def comment(self):
+        return self.table.comment(self.index)
+
+    @property
+    def block(self):
+        return self.table.block(self.index)
+
+    @property
+    def code(self):
+        return self.table.code(self.index)
+
+    @property
+    def character(self):
+        return self.table.character(self.index)
+
+    @property
+    def html_entity(self):
+        return self.table.html_entity(self.index)
+
+    def get_search_name(self):
+        """ Called by `ulauncher.search.SortedList` to get the string
+        that should be used in searches
+        """
+        return self.table.search_keys[self.index]
+
+
+class StaleSnapshotError(Exception):
+    """ Raised when a snapshot is missing, damaged or out of date
+    """
+
+
+class CharacterTable(object):
+    """ Column store of the character table, a read-only sequence of `UnicodeChar`.
+
+    Each column is a flat array: code points, one utf-8 blob each for names and
+    comments with their offset arrays, and the id of each row's block in the
+    interned `blocks` list, plus the search key of every row. The columns are
+    usually memoryviews of the mapped snapshot, but the arrays and blobs returned
+    by `pack_table` work as well.
+    """
+
+    def __init__(self, sections):
+        self._codes = sections[b"CODE"]
+        self._name_offsets = sections[b"NOFF"]
+        self._comment_offsets = sections[b"COFF"]
+        self._names = sections[b"NAME"]
+        self._comments = sections[b"CMNT"]
+        self._row_blocks = sections[b"BLCK"]
+        self.blocks = str(sections[b"BNAM"], "utf-8").split("\n")
+        self._block_runs = sections[b"BRUN"]
+        self._length = len(self._codes)
+        self._entities = dict(
+            zip(sections[b"ECOD"], str(sections[b"ENAM"], "utf-8").split("\n"))
+        )
+        # Decoded once here so that fetching the key of a row does not allocate anything.
+        # Sliced since an empty table still splits into one empty key.
+        keys = str(sections[b"SKEY"], "utf-8", "surrogatepass")
+        self.search_keys = keys.split("\n")[:self._length]
+        # Length and character mask of each key, for `matcher.NumpyMatcher`
+        self.key_masks = (sections[b"KLEN"], sections[b"KMSK"])
+        self.token_index = TokenIndex(sections)
+        self.trigram_index = TrigramIndex(sections)
+        self.abbreviation_index = AbbreviationIndex(sections)
+        self.entity_index = EntityIndex(sections)
+        self._rows_by_code = dict(zip(self._codes, range(self._length)))
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        if not 0 <= index < self._length:
+            raise IndexError("character table index out of range")
+        return UnicodeChar(self, index)
+
+    def __iter__(self):
+        for index in range(self._length):
+            yield UnicodeChar(self, index)
+
+    def find_blocks(self, name):
+        """ Ids of the blocks called `name`, or if there is none, of the blocks
+        whose name contains it. Case is ignored and "_" stands for a space.
+        """
+        name = name.lower().replace("_", " ")
+        lowered = [block.lower() for block in self.blocks]
+        if name in lowered:
+            return [lowered.index(name)]
+        return [block_id for block_id, block in enumerate(lowered) if name and name in block]
+
+    def block_rows(self, block_ids):
+        """ `(start, end)` row ranges of the given blocks, in table order
+        """
+        runs = self._block_runs
+        return [
+            (runs[i + 1], runs[i + 2])
+            for i in range(0, len(runs), 3)
+            if runs[i] in block_ids
+        ]
+
+    def find_code(self, code):
+        """ Row of the character with code point `code`, or None
+        """
+        return self._rows_by_code.get(code)
+
+    def raw_name(self, index):
+        """ Name as listed in the table, `<control>` for control characters
+        """
+        offsets = self._name_offsets
+        return str(self._names[offsets[index]:offsets[index + 1] - 1], "utf-8")
+
+    def comment(self, index):
+        offsets = self._comment_offsets
+        return str(self._comments[offsets[index]:offsets[index + 1] - 1], "utf-8")
+
+    def code(self, index):
+        return "%04X" % self._codes[index]
+
+    def block(self, index):
+        return self.blocks[self._row_blocks[index]]
+
+    def character(self, index):
+        return chr(self._codes[index])
+
+    def html_entity(self, index):
+        """ Named HTML entity of the character, e.g. `&rarr;`, or an empty string
+        """
+        name = self._entities.get(self._codes[index])
+        return "&%s;" % name if name else ""
+
+
+def parse_table(text):
+    """ Parse the contents of `unicode_list.txt` into a list of
+    `(name, comment, code, block)` tuples.
+    """
+    rows = []
+    for line in text.split("\n"):
+        if line:
+            name, comment, code, block = line.rstrip("\r").split("\t")
+            rows.append((name, comment, code, block))
+    return rows
+
+
+# Blocks of the East Asian scripts, whose letters and ideographs "no-cjk" leaves out
+EAST_ASIAN_BLOCK = re.compile(
+    r"^(?:CJK|Hangul|Hiragana|Katakana|Kana|Small Kana|Bopomofo|Kangxi|Kanbun|Ideographic"
+    r"|Yi|Tangut|Khitan|Nushu)\b"
+)
+
+# General categories "symbols" keeps: symbols, punctuation, spaces and non-digit numbers
+SYMBOL_CATEGORIES = ("S", "P", "Zs", "No", "Nl")
+
+
+def _category(code):
+    return unicodedata.category(chr(int(code, 16)))
+
+
+def _is_character(row):
+    """ Whether a row is neither a control nor one of the markers of the first
+    and last code point of a range, like `<CJK Ideograph, First>`
+    """
+    name = row[0]
+    if name == "<control>":
+        return False
+    return not (name.startswith("<") and name.endswith((", First>", ", Last>")))
+
+
+def _is_not_cjk(row):
+    """ Whether a row is a character outside the East Asian blocks, or
+    punctuation or a space in them
+    """
+    if not _is_character(row):
+        return False
+    if not EAST_ASIAN_BLOCK.match(row[3]):
+        return True
+    return _category(row[2]).startswith(("P", "Zs"))
+
+
+def _is_symbol(row):
+    """ Whether a row is a character in one of `SYMBOL_CATEGORIES`. Characters
+    newer than the `unicodedata` of this Python have no category and are kept.
+    """
+    if not _is_character(row):
+        return False
+    category = _category(row[2])
+    return category == "Cn" or category.startswith(SYMBOL_CATEGORIES)
+
+
+# Rows each profile keeps, None for all of them
+PROFILES = {
+    "full": None,
+    "no-controls": _is_character,
+    "no-cjk": _is_not_cjk,
+    "symbols": _is_symbol,
+}
+
+
+def profile_rows(rows, profile):
+    """ The rows as returned by `parse_table` that `profile` keeps
+    """
+    keep = PROFILES[profile]
+    if keep is None:
+        return rows
+    return [row for row in rows if keep(row)]
+
+
+def snapshot_file(profile):
+    """ Name of the snapshot of `profile`
+    """
+    if profile == DEFAULT_PROFILE:
+        return SNAPSHOT_FILE
+    return "unicode_list.%s.bin" % profile
+
+
+def search_key(character, code, name, comment):
+    """ Normalized string a row is searched by: the character, its code, name
+    and comment, folded like queries are and with runs of whitespace
+    collapsed to single spaces.
+    """
+    if name == "<control>":
+        name = comment
+    return " ".join(fold(" ".join([character, code, name, comment])).split())
+
+
+def _pack_strings(strings):
+    """ Encode a list of strings to one newline separated utf-8 blob and the
+    offset of each string in it. The extra last offset points one past the end
+    of the blob so that string `i` is always `blob[offsets[i]:offsets[i + 1] - 1]`.
+    """
+    blob = "\n".join(strings).encode("utf-8")
+    offsets = array("I")
+    position = 0
+    for string in strings:
+        offsets.append(position)
+        position += len(string.encode("utf-8")) + 1
+    offsets.append(position)
+    return blob, offsets
+
+
+def pack_table(rows):
+    """ Turn rows as returned by `parse_table` into the columns stored
+    in a snapshot, as a list of `(tag, array or bytes)` pairs.
+    """
+    blocks = []
+    block_ids = {}
+    codes = array("I")
+    row_blocks = array("H")
+    # (block id, first row, end row) of each run of rows in the same block. Rows
+    # are sorted by code and blocks are code ranges, so usually one run per block.
+    block_runs = array("I")
+    for row, (name, comment, code, block) in enumerate(rows):
+        codes.append(int(code, 16))
+        if block not in block_ids:
+            block_ids[block] = len(blocks)
+            blocks.append(block)
+        if not row_blocks or row_blocks[-1] != block_ids[block]:
+            block_runs.extend((block_ids[block], row, row + 1))
+        block_runs[-1] = row + 1
+        row_blocks.append(block_ids[block])
+    names, name_offsets = _pack_strings([row[0] for row in rows])
+    comments, comment_offsets = _pack_strings([row[1] for row in rows])
+    block_names, block_offsets = _pack_strings(blocks)
+    keys = [
+        search_key(chr(int(code, 16)), code, name, comment)
+        for name, comment, code, block in rows
+    ]
+    # Named HTML entities, the same table `htmlentities.encode` used to look up
+    known_codes = set(codes)
+    entity_codes = array("I", sorted(code for code in codepoint2name if code in known_codes))
+    entity_names, _ = _pack_strings([codepoint2name[code] for code in entity_codes])
+    # Every name of the single character HTML5 entities, for the `EntityIndex`
+    entity_aliases = {}
+    for entity, value in html5.items():
+        if len(value) == 1:
+            entity_aliases.setdefault(ord(value), set()).add(entity.rstrip(";").lower())
+    return [
+        (b"CODE", codes),
+        (b"NOFF", name_offsets),
+        (b"COFF", comment_offsets),
+        (b"BOFF", block_offsets),
+        (b"BLCK", row_blocks),
+        (b"BRUN", block_runs),
+        (b"NAME", names),
+        (b"CMNT", comments),
+        (b"BNAM", block_names),
+        (b"ECOD", entity_codes),
+        (b"ENAM", entity_names),
+        (b"SKEY", "\n".join(keys).encode("utf-8", "surrogatepass")),
+    ] + pack_key_masks(keys) + pack_token_index(
+        [row_terms(name, comment) for name, comment, code, block in rows]
+    ) + pack_trigram_index(keys) + pack_abbreviation_index([
+        initials(comment if name == "<control>" else name)
+        for name, comment, code, block in rows
+    ]) + pack_entity_index([entity_aliases.get(code, ()) for code in codes])
+
+
+def serialize_snapshot(columns, source):
+    """ Serialize `columns` as returned by `pack_table` to the snapshot format
+    """
+    directory_size = _HEADER.size + _SECTION.size * len(columns)
+    entries = []
+    payload = []
+    offset = directory_size
+    for tag, data in columns:
+        if isinstance(data, array):
+            typecode = data.typecode
+            if sys.byteorder != "little":
+                data = array(typecode, data)
+                data.byteswap()
+            data = data.tobytes()
+        else:
+            typecode = "B"
+        entries.append(_SECTION.pack(tag, typecode.encode("ascii"), offset, len(data)))
+        # Keep every section 8-byte aligned so it can be cast in place
+        padding = -len(data) % 8
+        payload.append(data + b"\0" * padding)
+        offset += len(data) + padding
+    header = _HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(columns), *source)
+    return header + b"".join(entries) + b"".join(payload)
+
+
+def write_snapshot(path, columns, source):
+    """ Write `columns` as returned by `pack_table` to a snapshot file at `path`.
+
+    The file is replaced atomically: running extensions may have the old
+    snapshot mapped, and truncating it in place would pull it from under them.
+    """
+    temp_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(temp_path, "wb") as target:
+        target.write(serialize_snapshot(columns, source))
+    os.rename(temp_path, path)
+
+
+def read_snapshot(data, source=None):
+    """ Parse a snapshot into a dict of tag -> section. `data` can be anything
+    that supports the buffer protocol; sections are zero-copy memoryviews of it,
+    cast to their array typecode.
+
+    Raises `StaleSnapshotError` if the data was not written by this version or,
+    when given, does not match the `source_signature` of the source file.
+    """
+    data = memoryview(data)
+    if len(data) < _HEADER.size:
+        raise StaleSnapshotError("truncated header")
+    magic, version, count, size, mtime = _HEADER.unpack_from(data, 0)
+    if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+        raise StaleSnapshotError("unknown format %r version %d" % (magic, version))
+    if source is not None and (size, mtime) != tuple(source):
+        raise StaleSnapshotError("built from a different %s" % TABLE_FILE)
+    sections = {}
+    for i in range(count):
+        tag, typecode, offset, length = _SECTION.unpack_from(
+            data, _HEADER.size + i * _SECTION.size
+        )
+        if offset + length > len(data):
+            raise StaleSnapshotError("truncated section %r" % tag)
+        section = data[offset:offset + length]
+        typecode = typecode.decode("ascii")
+        if typecode == "B":
+            pass
+        elif sys.byteorder == "little":
+            section = section.cast(typecode)
+        else:
+            section = array(typecode, section.tobytes())
+            section.byteswap()
+        sections[tag] = section
+    return sections
+
+
+def source_signature(path):
+    """ Size and modification time in nanoseconds of the text table at `path`,
+    recorded in snapshots built from it. Checking them takes a `stat` rather
+    than reading the whole table on every start.
+    """
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def build_snapshot(directory, profile=DEFAULT_PROFILE):
+    """ (Re)build the snapshot of `profile` in `directory` from its text table
+    """
+    table_path = join(directory, TABLE_FILE)
+    source = source_signature(table_path)
+    with open(table_path, "rb") as f:
+        text_data = f.read()
+    rows = profile_rows(parse_table(text_data.decode("utf-8")), profile)
+    write_snapshot(join(directory, snapshot_file(profile)), pack_table(rows), source)
+    return rows
+
+
+def map_snapshot(path):
+    """ Memory map the snapshot at `path` read-only. The mapping is shared with
+    every other process that maps the same file, so several sessions share one
+    copy of the table in the page cache.
+    """
+    with open(path, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def empty_character_table():
+    """ Table without any rows, for use until the real one is loaded
+    """
+    return CharacterTable(dict(pack_table([])))
+
+
+def load_character_table(directory, profile=DEFAULT_PROFILE):
+    """ Return the `CharacterTable` of `profile` for the table in `directory`.
+
+    The snapshot is memory mapped if it is up to date. Otherwise it is rebuilt
+    from the text table, and if it cannot be written the table is served from
+    the columns built in memory instead.
+    """
+    table_path = join(directory, TABLE_FILE)
+    source = source_signature(table_path)
+    snapshot_path = join(directory, snapshot_file(profile))
+    try:
+        return CharacterTable(read_snapshot(map_snapshot(snapshot_path), source))
+    except (IOError, OSError, ValueError, StaleSnapshotError) as e:
+        logger.info("Not using character table snapshot: %s", e)
+
+    with open(table_path, "rb") as f:
+        text_data = f.read()
+    columns = pack_table(profile_rows(parse_table(text_data.decode("utf-8")), profile))
+    try:
+        write_snapshot(snapshot_path, columns, source)
+        return CharacterTable(read_snapshot(map_snapshot(snapshot_path), source))
+    except (IOError, OSError, ValueError, StaleSnapshotError) as e:
+        logger.warning("Could not write character table snapshot: %s", e)
+    return CharacterTable(dict(columns))
@@ -1,11 +1,15 @@
 """
 Download the latest unicode tables from  https://www.unicode.org and create a .txt file
-containing all the names, blocks and character codes
+containing all the names, blocks and character codes, plus a binary snapshot of the
+same table for each profile that the extension can load at startup.
 """
 import os
 import logging
+import argparse
 from urllib import request
 
+from character_table import PROFILES, build_snapshot, snapshot_file
+
 curr_path = os.path.dirname(__file__)
 logging.basicConfig(level=logging.DEBUG)
 
@@ -69,11 +73,35 @@ def load_blocks():
     return locate_block
 
 
+def build_snapshots(profiles):
+    """ Write the snapshot of each of `profiles` from the text file
+    """
+    for profile in profiles:
+        logging.info("Writing binary snapshot %s...", snapshot_file(profile))
+        rows = build_snapshot(".", profile)
+        logging.info("%d characters in profile %s", len(rows), profile)
+
+
 def main():
     """ Read the character and block data and unite them to a text file containing the following fields:
     `<character name>   <character comment> <code>  <block name>`
     seperated by tab characters.
     """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--profile", action="append", choices=sorted(PROFILES),
+        help="profile to write a snapshot for, can be repeated (default: all of them)",
+    )
+    parser.add_argument(
+        "--snapshots-only", action="store_true",
+        help="only rebuild the snapshots from the existing unicode_list.txt",
+    )
+    args = parser.parse_args()
+    profiles = args.profile or sorted(PROFILES)
+    if args.snapshots_only:
+        build_snapshots(profiles)
+        return
+
     get_block = load_blocks()
     characters = clean(get_data())
 
@@ -104,6 +132,8 @@ def main():
     with open("unicode_list.txt", "w") as target:
         target.write("\n".join(output))
 
+    build_snapshots(profiles)
+
 
 if __name__ == "__main__":
     main()
@@ -1,25 +1,53 @@
 import os
 import sys
+import atexit
 import codecs
-from os.path import join
+import logging
+import time
+import bisect
+import itertools
+import threading
 
-import subprocess # for pip autoinstallation
-
-from ulauncher.search.SortedList import SortedList
 from ulauncher.api.client.Extension import Extension
 from ulauncher.api.client.EventListener import EventListener
-from ulauncher.api.shared.event import KeywordQueryEvent, ItemEnterEvent
+from ulauncher.api.shared.event import (
+    KeywordQueryEvent, ItemEnterEvent, PreferencesEvent, PreferencesUpdateEvent
+)
+from ulauncher.api.shared.Response import Response
 from ulauncher.api.shared.item.ExtensionResultItem import ExtensionResultItem
 from ulauncher.api.shared.action.RenderResultListAction import RenderResultListAction
 from ulauncher.api.shared.action.CopyToClipboardAction import CopyToClipboardAction
 from ulauncher.api.shared.action.HideWindowAction import HideWindowAction
+from ulauncher.api.shared.action.ExtensionCustomAction import ExtensionCustomAction
+
+from character_table import (
+    DEFAULT_PROFILE, PROFILES, empty_character_table, load_character_table
+)
+from matcher import QueryCancelled, create_matcher
+from query_latency import QueryLatency, parse_debounce
+from result_cache import ResultCache
+from usage_store import UsageStore, usage_path
+from search_index import (
+    TOKEN_STAGE, TRIGRAM_STAGE, QueryRefiner, literal_code_points, normalize_query,
+    parse_block_filter, parse_code_point, query_terms,
+)
 
-# Be compatible with both python 2 and 3
-if sys.version_info[0] >= 3:
-    unichr = chr
+logger = logging.getLogger(__name__)
 
 FILE_PATH = os.path.dirname(sys.argv[0])
 
+# How long a query that arrives while the table is still loading waits for it, in seconds
+LOAD_TIMEOUT = 2.0
+
+# Rough size in bytes of a result item besides its strings, for the result cache
+RESULT_ITEM_SIZE = 512
+
+# Number of answered queries between two log lines with their latency
+LATENCY_LOG_INTERVAL = 100
+
+# Number of the most used characters listed when the query is empty
+FRECENT_LIMIT = 10
+
 ICON_TEMPLATE = """
 <svg width="100" height="100" xmlns="http://www.w3.org/2000/svg">
   <circle cx="50" cy="50" r="50" fill="white" />
@@ -27,80 +55,516 @@ ICON_TEMPLATE = """
 </svg>
 """
 
-# For pip autoinstallation
-def ensure_import(package):
-    try:
-        return __import__(package)
-    except ImportError:
-        subprocess.call([sys.executable, "-m", "pip", "install", "--user", package])
-    return __import__(package)
 
-# For HTML entity conversion
-htmlentities = ensure_import("htmlentities")
-
-class UnicodeChar:
-    """ Container class for unicode characters
+class SearchState(object):
+    """ What queries search: the character table, its matcher and the rows of
+    its most used characters, most used first. A state is never changed but
+    replaced as a whole, so a query that reads `UnicodeCharExtension.state`
+    once only sees rows and a matcher of the same table. Results are cached
+    by the `generation` of the state they were built from.
     """
 
-    def __init__(self, name, comment, block, code):
-        self.name = name if name != '<control>' else comment
-        self.comment = comment
-        self.block = block
-        self.code = code
-        self.character = unichr(int(code, 16))
+    _generations = itertools.count()
 
-    def get_search_name(self):
-        """ Called by `ulauncher.search.SortedList` to get the string
-        that should be used in searches
-        """
-        return ' '.join([self.character, self.code, self.name, self.comment])
+    def __init__(self, table, matcher, hot_rows):
+        self.table = table
+        self.matcher = matcher
+        self.hot_rows = hot_rows
+        self.generation = next(SearchState._generations)
 
 
 class UnicodeCharExtension(Extension):
     def __init__(self):
         super(UnicodeCharExtension, self).__init__()
-        check_cache_dir()
-        self._load_character_table()
+        table = empty_character_table()
+        self.state = SearchState(
+            table, create_matcher(table.search_keys, key_masks=table.key_masks), []
+        )
+        self.search_workers = 0
+        # Dataset profile of the table to search, and the one currently loaded
+        self.profile = DEFAULT_PROFILE
+        self._loaded_profile = None
+        self._profile_lock = threading.Lock()
+        # Seconds to wait for typing to pause before searching, None to adapt to the query time
+        self.query_debounce = None
+        self._matcher_lock = threading.Lock()
+        # Matcher the running query searches, and replaced matchers that wait
+        # for it to finish before they are closed
+        self._search_lock = threading.Lock()
+        self._busy_matcher = None
+        self._retired_matchers = []
+        self.table_ready = threading.Event()
+        self.result_cache = ResultCache()
+        self.usage = UsageStore(usage_path())
+        # Result items of the first of those, shown for an empty query
+        self.frecent_items = []
         self.subscribe(KeywordQueryEvent, KeywordQueryEventListener())
+        self.subscribe(ItemEnterEvent, ItemEnterEventListener())
+        self.subscribe(PreferencesEvent, PreferencesEventListener())
+        self.subscribe(PreferencesUpdateEvent, PreferencesUpdateEventListener())
+        atexit.register(self._close_matcher)
+        # Load in the background so that `run()` can connect to Ulauncher right away
+        loader = threading.Thread(target=self._load_character_table, name="character-table")
+        loader.daemon = True
+        loader.start()
 
     def _load_character_table(self):
         """ Read the data file and load to memory
         """
-        self.character_list = []
-        with open(join(FILE_PATH, "unicode_list.txt"), "r") as f:
-            for line in f.readlines():
-                name, comment, code, block = line.strip().split("\t")
-                character = UnicodeChar(name, comment, block, code)
-                self.character_list.append(character)
+        try:
+            check_cache_dir()
+            self.usage.load()
+            self._load_profile()
+        except Exception:
+            logger.exception("Could not load the character table")
+        finally:
+            self.table_ready.set()
+        # The preferences may have changed after the table and matcher were loaded
+        if self._loaded_profile != self.profile:
+            self._load_profile()
+        if self.state.matcher.workers != self.search_workers:
+            self._configure_matcher()
+
+    def _load_profile(self):
+        """ Load the table of the `profile` preference, again if the preference
+        changed while loading, and switch searching over to it
+        """
+        with self._profile_lock:
+            while self._loaded_profile != self.profile:
+                profile = self.profile
+                self._configure_matcher(load_character_table(FILE_PATH, profile))
+                self._loaded_profile = profile
+                self._update_frecent_items()
+                self.result_cache.clear()
+
+    def _configure_matcher(self, table=None):
+        """ (Re)build the matcher of the loaded table, or of `table` which then
+        replaces it, for the current number of search worker processes, and
+        stop the previous one.
+        """
+        with self._matcher_lock:
+            previous = self.state
+            if table is None:
+                table = previous.table
+            matcher = create_matcher(
+                table.search_keys, workers=self.search_workers, key_masks=table.key_masks
+            )
+            self.state = SearchState(table, matcher, self._hot_rows(table))
+        self._retire_matcher(previous.matcher)
+
+    def _retire_matcher(self, matcher):
+        """ Close a replaced `matcher`, or have `end_search` close it if the
+        running query still searches it: its worker pipes are not safe to
+        write to from two threads.
+        """
+        with self._search_lock:
+            if matcher is self._busy_matcher:
+                self._retired_matchers.append(matcher)
+                return
+        matcher.close()
+
+    def begin_search(self):
+        """ Current `SearchState`, for a query that calls `end_search` when it
+        is done with it. Its matcher is not closed until then.
+        """
+        with self._search_lock:
+            state = self.state
+            self._busy_matcher = state.matcher
+        return state
+
+    def end_search(self):
+        with self._search_lock:
+            self._busy_matcher = None
+            retired, self._retired_matchers = self._retired_matchers, []
+        # Closing joins the worker processes, which the next query need not wait for
+        for matcher in retired:
+            close = threading.Thread(target=matcher.close, name="matcher")
+            close.daemon = True
+            close.start()
+
+    def _close_matcher(self):
+        self.state.matcher.close()
+
+    def _hot_rows(self, table):
+        """ Rows of `table` of the most used characters, most used first
+        """
+        rows = [table.find_code(code) for code in self.usage.hot_codes]
+        return [row for row in rows if row is not None]
+
+    def _update_hot_rows(self):
+        with self._matcher_lock:
+            state = self.state
+            self.state = SearchState(state.table, state.matcher, self._hot_rows(state.table))
+
+    def _update_frecent_items(self):
+        """ Build the items shown for an empty query ahead of time, creating
+        their icons here rather than while answering the query. Counts all
+        decay at the same rate, so their order only changes with a selection.
+        """
+        state = self.state
+        self.frecent_items = [
+            result_item(state.table[row]) for row in state.hot_rows[:FRECENT_LIMIT]
+        ]
+
+    def record_selection(self, code):
+        """ Count a character copied from the results in the usage store
+        """
+        self.usage.record(code)
+        self._update_hot_rows()
+        # Cached results were ranked by the previous counts, of the replaced state
+        self.result_cache.clear()
+        update = threading.Thread(target=self._update_frecent_items, name="frecent")
+        update.daemon = True
+        update.start()
+
+    def set_profile(self, value):
+        """ Apply the `profile` preference
+        """
+        if value not in PROFILES:
+            logger.warning("Unknown profile %r, using %s", value, DEFAULT_PROFILE)
+            value = DEFAULT_PROFILE
+        if value == self.profile:
+            return
+        self.profile = value
+        # Until the table is loaded, the loader picks the new value up itself
+        if self.table_ready.is_set():
+            load = threading.Thread(target=self._load_profile, name="character-table")
+            load.daemon = True
+            load.start()
+
+    def set_search_workers(self, value):
+        """ Apply the `search_workers` preference
+        """
+        try:
+            workers = max(0, int(value))
+        except (TypeError, ValueError):
+            workers = 0
+        if workers == self.search_workers:
+            return
+        self.search_workers = workers
+        # Until the table is loaded, the loader picks the new value up itself
+        if self.table_ready.is_set():
+            configure = threading.Thread(target=self._configure_matcher, name="matcher")
+            configure.daemon = True
+            configure.start()
+
+
+class PreferencesEventListener(EventListener):
+    def on_event(self, event, extension):
+        extension.set_search_workers(event.preferences.get("search_workers"))
+        extension.set_profile(event.preferences.get("profile", DEFAULT_PROFILE))
+        extension.query_debounce = parse_debounce(event.preferences.get("query_debounce"))
+
+
+class PreferencesUpdateEventListener(EventListener):
+    def on_event(self, event, extension):
+        if event.id == "search_workers":
+            extension.set_search_workers(event.new_value)
+        elif event.id == "query_debounce":
+            extension.query_debounce = parse_debounce(event.new_value)
+        elif event.id == "profile":
+            extension.set_profile(event.new_value)
+
+
+class ItemEnterEventListener(EventListener):
+    """ Copies the text of a selected result, and counts the selection
+    """
+
+    def on_event(self, event, extension):
+        data = event.get_data()
+        extension.record_selection(data["code"])
+        return CopyToClipboardAction(data["text"])
 
 
 class KeywordQueryEventListener(EventListener):
+    """ Answers queries on a search thread of its own, so that the events of
+    further keystrokes keep arriving while a query runs. Each query gets a
+    generation number; a query that a newer one superseded stops scoring and
+    building results at its next check, and its response is never sent.
+
+    The search thread also debounces queries itself, by the `query_debounce`
+    preference or, by default, by what `QueryLatency` chooses for the time
+    the last queries took.
+    """
+
+    def __init__(self):
+        self.refiner = QueryRefiner()
+        self.latency = QueryLatency()
+        self.generation = 0
+        self._pending = None
+        self._condition = threading.Condition()
+        self._thread = None
+
     def on_event(self, event, extension):
-        items = []
+        with self._condition:
+            self.generation += 1
+            self._pending = (self.generation, event, extension)
+            self._condition.notify()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._search_loop, name="search")
+                self._thread.daemon = True
+                self._thread.start()
+        # The response is sent by the search thread
+        return None
+
+    def _search_loop(self):
+        while True:
+            with self._condition:
+                while self._pending is None:
+                    self._condition.wait()
+                if self._pending[1].get_argument():
+                    self._debounce(self.debounce(self._pending[2]))
+                generation, event, extension = self._pending
+                self._pending = None
+            # Waiting for the table to load is no query time, it would pin the
+            # debounce at its maximum for the queries typed after startup
+            ready = extension.table_ready.is_set()
+            start = time.time()
+            try:
+                action = self.search(event, extension, generation)
+            except QueryCancelled:
+                continue
+            except Exception:
+                logger.exception("Query %r failed", event.get_argument())
+                continue
+            if not self.is_stale(generation):
+                extension._client.send(Response(event, action))
+                if ready:
+                    self._record_latency(time.time() - start, extension)
+
+    def _debounce(self, delay):
+        """ Wait, holding the condition, until no query arrived for `delay` seconds
+        """
+        while delay > 0:
+            pending = self._pending
+            self._condition.wait(delay)
+            if self._pending is pending:
+                break
+
+    def debounce(self, extension):
+        """ Seconds to wait for typing to pause before searching
+        """
+        if extension.query_debounce is not None:
+            return extension.query_debounce
+        return self.latency.debounce()
+
+    def _record_latency(self, duration, extension):
+        self.latency.record(duration)
+        if self.latency.count % LATENCY_LOG_INTERVAL == 0:
+            cache = extension.result_cache
+            logger.info(
+                "Query time p50 %.1f ms, p95 %.1f ms over the last %d queries, "
+                "debounce %.0f ms%s, result cache %d hits, %d misses",
+                self.latency.percentile(0.5) * 1000,
+                self.latency.percentile(0.95) * 1000,
+                len(self.latency),
+                self.debounce(extension) * 1000,
+                "" if extension.query_debounce is None else " (preference)",
+                cache.hits,
+                cache.misses,
+            )
+
+    def is_stale(self, generation):
+        """ Whether a newer query than the one of `generation` arrived
+        """
+        return generation != self.generation
+
+    def search(self, event, extension, generation):
+        """ Result list action for `event`. Raises `QueryCancelled` when a
+        newer query arrives before it is complete.
+        """
+        def cancelled():
+            return self.is_stale(generation)
+
         arg = event.get_argument()
-        if arg:
-            result_list = SortedList(arg, min_score=99, limit=10)
-            result_list.extend(extension.character_list)
-            for char in result_list:
-                image_path = get_character_icon(char)
-                encoded = htmlentities.encode(char.character)
-                if "&" in encoded:
-                    sep = " - "
-                    html = encoded
-                else:
-                    sep = ""
-                    html = ""
-                items.append(
-                    ExtensionResultItem(
-                        icon=image_path,
-                        name=char.name.capitalize() + " - " + char.character,
-                        description=char.block + " - Alt+Enter: " + html + sep + "Code: U+" + char.code,
-                        on_enter=CopyToClipboardAction(char.character),
-                        on_alt_enter=CopyToClipboardAction(html),
-                    )
-                )
+        # The panel of the most used characters is built ahead of time
+        if not arg:
+            return RenderResultListAction(extension.frecent_items)
+        if not extension.table_ready.wait(LOAD_TIMEOUT):
+            return RenderResultListAction([loading_item()])
+        # Read once: a profile switch or a selection replaces the state while
+        # this query runs, and the results of a replaced one are never served
+        state = extension.begin_search()
+        try:
+            items = self.result_items(state, arg, extension.result_cache, cancelled)
+        finally:
+            extension.end_search()
         return RenderResultListAction(items)
 
+    def result_items(self, state, arg, result_cache, cancelled):
+        """ Result items of the query `arg` in `state`, from `result_cache` if
+        it has them
+        """
+        key = (state.generation, " ".join(arg.split()))
+        items = result_cache.get(key)
+        if items is None:
+            items = []
+            size = 0
+            for char in search_characters(
+                state.table, state.matcher, arg, self.refiner,
+                cancelled=cancelled, hot_rows=state.hot_rows,
+            ):
+                # Creating an icon writes a file, so check before each one
+                if cancelled():
+                    raise QueryCancelled()
+                items.append(result_item(char))
+                size += RESULT_ITEM_SIZE + len(char.name) + len(char.block)
+            result_cache.put(key, items, size)
+        return items
+
+
+def search_characters(
+    table, matcher, query, refiner, limit=10, cancelled=None, hot_rows=None
+):
+    """ Return the `UnicodeChar`s of `table` matching `query`, best first.
+    `matcher` scores the search keys of `table`, and `refiner` is the
+    `QueryRefiner` that keeps the candidates of earlier queries. Scoring
+    raises `QueryCancelled` once `cancelled`, if given, returns True.
+    The `hot_rows` of the most used characters that match come first.
+    """
+    block_name, query = parse_block_filter(query)
+    if block_name is not None:
+        return search_blocks(table, matcher, block_name, query, refiner, limit, cancelled)
+
+    exact = []
+    code_point = parse_code_point(query)
+    if code_point is not None:
+        code, explicit = code_point
+        row = table.find_code(code)
+        if row is not None:
+            exact.append(table[row])
+            if explicit:
+                return exact
+
+    # Pasted characters: one result per character, and for a single character
+    # the fuzzy results follow since it is also matched by the search keys
+    literal = literal_code_points(query, table.find_code)
+    if literal is not None:
+        rows = [table.find_code(code) for code in literal]
+        exact.extend(table[row] for row in rows if row is not None)
+        if len(literal) > 1:
+            return exact[:limit]
+
+    query = normalize_query(query)
+    # The most used characters are scored first, and when enough of them
+    # match there is no need to search the rest of the table
+    hot = []
+    if hot_rows:
+        matched = set(matcher.top_matches(query, sorted(hot_rows), len(hot_rows)))
+        hot = [row for row in hot_rows if row in matched]
+    if len(hot) >= limit:
+        rows = hot
+    else:
+        # HTML entity names like "gt" or "rarr" resolve in one lookup and come
+        # before the rows that only have the query among their words
+        entity = table.entity_index.candidates(query)
+        # Initials like "lrarr" are no word of any name and resolve in one lookup
+        rows = table.abbreviation_index.candidates(table, query)
+        if rows:
+            rows = rows[:limit]
+        else:
+            rows = match_rows(table, matcher, query, refiner, limit, cancelled)
+        first = hot + [row for row in entity if row not in hot]
+        first_set = set(first)
+        rows = first + [row for row in rows if row not in first_set]
+
+    exact_rows = set(char.index for char in exact)
+    matches = [table[row] for row in rows if row not in exact_rows]
+    return exact + matches[:limit - len(exact)]
+
+
+def match_rows(table, matcher, query, refiner, limit=10, cancelled=None, ranges=None):
+    """ Ids of the rows best matching `query` by name. Only the rows the
+    indexes narrow the query down to are scored, and the whole table is
+    scored if none of those match. Rows with the words of the query are
+    ranked by their term weights, the others by fuzzy scoring. A single word
+    in the middle of the words of some rows only matches those, see
+    `TRIGRAM_STAGE`. Given `ranges` of rows, only the rows within those are
+    searched.
+    """
+    for stage, candidates in enumerate(refiner.candidate_rows(table, query)):
+        if candidates and ranges is not None:
+            candidates = rows_in_ranges(candidates, ranges)
+        if not candidates:
+            continue
+        if stage == TOKEN_STAGE:
+            terms = query_terms(query)
+            rows = table.token_index.rank(candidates, terms, limit)
+        else:
+            rows = matcher.top_matches(query, candidates, limit, cancelled=cancelled)
+            if not rows and stage == TRIGRAM_STAGE and " " not in query:
+                keys = table.search_keys
+                rows = [row for row in candidates if query in keys[row]]
+                if rows:
+                    return matcher.top_matches(query, rows, limit, 0, cancelled)
+        if rows:
+            return rows
+    rows = None
+    if ranges is not None:
+        rows = itertools.chain.from_iterable(range(start, end) for start, end in ranges)
+    return matcher.top_matches(query, rows, limit, cancelled=cancelled)
+
+
+def rows_in_ranges(rows, ranges):
+    """ Rows out of the ascending `rows` that are within one of the ascending
+    `(start, end)` row `ranges`
+    """
+    matches = []
+    for start, end in ranges:
+        matches.extend(
+            rows[bisect.bisect_left(rows, start):bisect.bisect_left(rows, end)]
+        )
+    return matches
+
+
+def search_blocks(table, matcher, block_name, query, refiner, limit=10, cancelled=None):
+    """ Search only the rows of the blocks matching `block_name`. Blocks are
+    contiguous in the code sorted table, so their rows are slices of it, and
+    the candidates of the indexes are cut down to those slices.
+    """
+    ranges = table.block_rows(table.find_blocks(block_name))
+    if not query:
+        rows = itertools.chain.from_iterable(range(start, end) for start, end in ranges)
+        return [table[row] for row in itertools.islice(rows, limit)]
+    query = normalize_query(query)
+    entity = rows_in_ranges(table.entity_index.candidates(query), ranges)
+    rows = table.abbreviation_index.candidates(table, query)
+    if rows:
+        rows = [row for row in rows if any(start <= row < end for start, end in ranges)]
+    if rows:
+        rows = rows[:limit]
+    else:
+        rows = match_rows(table, matcher, query, refiner, limit, cancelled, ranges)
+    entity_set = set(entity)
+    rows = entity + [row for row in rows if row not in entity_set]
+    return [table[row] for row in rows[:limit]]
+
+
+def result_item(char):
+    """ Result list entry for a `UnicodeChar`
+    """
+    html = char.html_entity
+    sep = " - " if html else ""
+    return ExtensionResultItem(
+        icon=get_character_icon(char),
+        name=char.name.capitalize() + " - " + char.character,
+        description=char.block + " - Alt+Enter: " + html + sep + "Code: U+" + char.code,
+        on_enter=ExtensionCustomAction({"code": ord(char.character), "text": char.character}),
+        on_alt_enter=ExtensionCustomAction({"code": ord(char.character), "text": html}),
+    )
+
+
+def loading_item():
+    """ Placeholder result shown while the character table is still loading
+    """
+    return ExtensionResultItem(
+        icon="images/insertion-symbol.png",
+        name="Loading symbols...",
+        description="The character table is still loading, try again in a moment",
+        on_enter=HideWindowAction(),
+    )
+
+
 def get_character_icon(char):
     """ Check if there is an existing icon for this character and return its path
     or create a new one and return its path.
@@ -0,0 +1,297 @@
+"""
+Top-k fuzzy matching of a query against the search keys of the table.
+
+Scores rows with the same function as `ulauncher.search.SortedList`, but in a
+single pass that keeps only the best `limit` rows in a min-heap and skips rows
+that cannot beat the current k-th best score. When NumPy is available,
+`create_matcher` returns a matcher that rules rows out for the whole table at
+once with vectorized operations before scoring the rest, and it can also shard
+the table across worker processes.
+"""
+import heapq
+import logging
+import multiprocessing
+from bisect import bisect_left
+
+from ulauncher.utils.fuzzy_search import get_score
+
+from search_index import character_mask, pack_key_masks
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+logger = logging.getLogger(__name__)
+
+# Weight of each character beyond the query length in the length penalty of `get_score`
+LENGTH_PENALTY = 0.001
+
+# Number of rows scored between two checks of whether the query was cancelled
+CANCEL_INTERVAL = 256
+
+
+class QueryCancelled(Exception):
+    """ Raised out of scoring when the `cancelled` callback of the query
+    reports that a newer query superseded it
+    """
+
+
+def max_text_length(query_len, min_score):
+    """ Longest text that can still score `min_score` against a query of
+    `query_len` characters. `get_score` caps at a full match at word starts,
+    which scores `100 * q / (q + (t - q) * LENGTH_PENALTY)` for a text of `t`
+    characters, so longer texts are skipped without scoring them.
+    """
+    if min_score <= 0:
+        return float("inf")
+    return query_len + (100.0 * query_len / min_score - query_len) / LENGTH_PENALTY
+
+
+def top_matches(query, keys, rows=None, limit=10, min_score=99, cancelled=None):
+    """ Ids of the at most `limit` rows whose key in `keys` best match `query`,
+    best first and in row order among equal scores, like `SortedList` would
+    return them. `rows` are the ascending ids of the rows to consider, all of
+    them by default. `cancelled`, if given, is called every `CANCEL_INTERVAL`
+    rows and `QueryCancelled` is raised as soon as it returns True.
+    """
+    return [
+        row for score, row in scored_matches(query, keys, rows, limit, min_score, cancelled)
+    ]
+
+
+def scored_matches(query, keys, rows=None, limit=10, min_score=99, cancelled=None):
+    """ Like `top_matches`, but as `(score, row)` pairs
+    """
+    query = query.lower().strip()
+    if not query or limit <= 0:
+        return []
+    if rows is None:
+        rows = range(len(keys))
+    query_len = len(query)
+    longest = max_text_length(query_len, min_score)
+    heap = []
+    for count, row in enumerate(rows):
+        if cancelled is not None and not count % CANCEL_INTERVAL and cancelled():
+            raise QueryCancelled()
+        key = keys[row]
+        if len(key) > longest:
+            continue
+        score = get_score(query, key)
+        if score < min_score:
+            continue
+        # Later rows lose ties, hence the negated row id
+        entry = (score, -row)
+        if len(heap) < limit:
+            heapq.heappush(heap, entry)
+        elif entry > heap[0]:
+            heapq.heapreplace(heap, entry)
+        else:
+            continue
+        if len(heap) == limit:
+            longest = max_text_length(query_len, max(min_score, heap[0][0]))
+    return [(score, -row) for score, row in sorted(heap, reverse=True)]
+
+
+class Matcher(object):
+    """ Pure Python matcher over a list of search keys
+    """
+
+    # Number of worker processes the matcher scores in
+    workers = 0
+
+    def __init__(self, keys):
+        self.keys = keys
+
+    def top_matches(self, query, rows=None, limit=10, min_score=99, cancelled=None):
+        """ See `top_matches`
+        """
+        return [
+            row for score, row in self.scored_matches(query, rows, limit, min_score, cancelled)
+        ]
+
+    def scored_matches(self, query, rows=None, limit=10, min_score=99, cancelled=None):
+        """ See `scored_matches`
+        """
+        return scored_matches(query, self.keys, rows, limit, min_score, cancelled)
+
+    def close(self):
+        """ Release the resources of the matcher, nothing to do in this process
+        """
+
+
+class NumpyMatcher(Matcher):
+    """ Matcher that keeps the length and a character mask of every key in
+    NumPy arrays. For a query it computes, for all rows at once, which rows
+    contain every character of the query and the best score the length of each
+    row allows. Only rows passing both are scored, in order of that upper
+    bound, stopping as soon as no remaining row can beat the k-th best score.
+
+    `key_masks` are the buffers of the lengths and masks of the keys as
+    written by `search_index.pack_key_masks`, usually the snapshot sections,
+    which the arrays are then views of. They are computed if not given.
+    """
+
+    def __init__(self, keys, key_masks=None):
+        super(NumpyMatcher, self).__init__(keys)
+        if key_masks is None:
+            key_masks = [column for tag, column in pack_key_masks(keys)]
+        lengths, masks = key_masks
+        self.lengths = numpy.frombuffer(lengths, numpy.uint32)
+        self.masks = numpy.frombuffer(masks, numpy.uint64)
+
+    def scored_matches(self, query, rows=None, limit=10, min_score=99, cancelled=None):
+        query = query.lower().strip()
+        if not query or limit <= 0:
+            return []
+        query_len = len(query)
+        if rows is None:
+            rows = numpy.arange(len(self.keys))
+        else:
+            rows = numpy.fromiter(rows, numpy.int64)
+        lengths = self.lengths[rows].astype(numpy.int64)
+        bounds = 100.0 * query_len / (
+            query_len + numpy.maximum(lengths - query_len, 0) * LENGTH_PENALTY
+        )
+        keep = bounds >= min_score
+        # Missing a single character of the query already scores below
+        # 100 * (q - 1) / q, and in that case every one of them must be present
+        if 100.0 * (query_len - 1) / query_len < min_score:
+            mask = numpy.uint64(character_mask(query))
+            keep &= (self.masks[rows] & mask) == mask
+        rows = rows[keep]
+        bounds = bounds[keep]
+        # Highest bound first, in row order among equal bounds
+        order = numpy.argsort(-bounds, kind="stable")
+
+        keys = self.keys
+        heap = []
+        candidates = zip(rows[order].tolist(), bounds[order].tolist())
+        for count, (row, bound) in enumerate(candidates):
+            if len(heap) == limit and bound < heap[0][0]:
+                break
+            if cancelled is not None and not count % CANCEL_INTERVAL and cancelled():
+                raise QueryCancelled()
+            score = get_score(query, keys[row])
+            if score < min_score:
+                continue
+            entry = (score, -row)
+            if len(heap) < limit:
+                heapq.heappush(heap, entry)
+            elif entry > heap[0]:
+                heapq.heapreplace(heap, entry)
+        return [(score, -row) for score, row in sorted(heap, reverse=True)]
+
+
+def _shard_worker(connection, keys, engine, key_masks):
+    """ Main loop of a `ShardedMatcher` worker: answer `scored_matches` requests
+    for its shard of the keys until the connection is closed or sends None.
+    """
+    shard = create_matcher(keys, engine, key_masks=key_masks)
+    while True:
+        try:
+            request = connection.recv()
+        except (EOFError, OSError):
+            break
+        if request is None:
+            break
+        connection.send(shard.scored_matches(*request))
+    connection.close()
+
+
+class ShardedMatcher(Matcher):
+    """ Matcher that splits the keys into contiguous shards, each held and
+    scored by its own worker process. A query is sent to every shard with
+    candidates in it, and the per-shard top matches are merged here. If a
+    worker fails, matching falls back to this process.
+    """
+
+    def __init__(self, keys, workers, engine="auto", timeout=5.0, key_masks=None):
+        super(ShardedMatcher, self).__init__(keys)
+        self.workers = workers
+        self.timeout = timeout
+        self._fallback = None
+        self._engine = engine
+        self._key_masks = key_masks
+        # Spawn rather than fork, the extension process runs several threads
+        context = multiprocessing.get_context("spawn")
+        size = max(1, -(-len(keys) // max(1, workers)))
+        self._shards = []
+        for start in range(0, len(keys), size):
+            shard_masks = None
+            if key_masks is not None:
+                shard_masks = [bytes(column[start:start + size]) for column in key_masks]
+            connection, worker_connection = context.Pipe()
+            process = context.Process(
+                target=_shard_worker,
+                args=(worker_connection, keys[start:start + size], engine, shard_masks),
+                name="symbol-search-%d" % len(self._shards),
+            )
+            process.daemon = True
+            process.start()
+            worker_connection.close()
+            self._shards.append((start, min(start + size, len(keys)), connection, process))
+
+    def scored_matches(self, query, rows=None, limit=10, min_score=99, cancelled=None):
+        """ See `scored_matches`. Workers cannot be interrupted once they got a
+        query, so `cancelled` is only checked before sending it to them.
+        """
+        if self._fallback is not None:
+            return self._fallback.scored_matches(query, rows, limit, min_score, cancelled)
+        if rows is not None:
+            rows = list(rows)
+        if cancelled is not None and cancelled():
+            raise QueryCancelled()
+        try:
+            pending = []
+            for start, end, connection, process in self._shards:
+                if rows is None:
+                    shard_rows = None
+                else:
+                    shard_rows = rows[bisect_left(rows, start):bisect_left(rows, end)]
+                    if not shard_rows:
+                        continue
+                    shard_rows = [row - start for row in shard_rows]
+                connection.send((query, shard_rows, limit, min_score))
+                pending.append((start, connection))
+            matches = []
+            for start, connection in pending:
+                if not connection.poll(self.timeout):
+                    raise OSError("search worker did not answer")
+                matches.extend((score, row + start) for score, row in connection.recv())
+        except (EOFError, OSError) as e:
+            logger.warning("Sharded search failed, searching in process: %s", e)
+            self.close()
+            self._fallback = create_matcher(self.keys, self._engine, key_masks=self._key_masks)
+            return self._fallback.scored_matches(query, rows, limit, min_score, cancelled)
+        # Best first, in row order among equal scores
+        matches.sort(key=lambda match: (-match[0], match[1]))
+        return matches[:limit]
+
+    def close(self):
+        """ Stop the worker processes
+        """
+        for start, end, connection, process in self._shards:
+            try:
+                connection.send(None)
+            except (EOFError, OSError):
+                pass
+        for start, end, connection, process in self._shards:
+            process.join(1.0)
+            if process.is_alive():
+                process.terminate()
+            connection.close()
+        self._shards = []
+
+
+def create_matcher(keys, engine="auto", workers=0, key_masks=None):
+    """ Matcher for `keys`: "numpy", "python", or "auto" to use NumPy if it
+    can be imported. With `workers` above zero, the keys are sharded across
+    that many worker processes that each use such a matcher. `key_masks` are
+    the length and mask columns of the keys for `NumpyMatcher`, if at hand.
+    """
+    if workers > 0:
+        return ShardedMatcher(keys, workers, engine, key_masks=key_masks)
+    if engine == "numpy" or (engine == "auto" and numpy is not None):
+        return NumpyMatcher(keys, key_masks)
+    return Matcher(keys)
@@ -0,0 +1,65 @@
+"""
+Measured latency of recent queries, and the query debounce chosen from it.
+
+Debouncing holds a query back until typing pauses, which only pays off when
+answering a query takes long enough to delay the next keystrokes. When the
+indexes answer in a few milliseconds the debounce is dropped altogether, and
+on slow machines it grows with the 95th percentile of the query time.
+"""
+
+# Queries whose p95 is below this many seconds are answered without any debounce
+FAST_QUERY = 0.02
+
+# Debounce as a multiple of the p95 query time, and its upper bound in seconds
+DEBOUNCE_FACTOR = 1.5
+MAX_DEBOUNCE = 0.5
+
+
+class QueryLatency(object):
+    """ Ring buffer of the durations of the last `window` queries, in seconds
+    """
+
+    def __init__(self, window=200):
+        self.window = window
+        self.count = 0
+        self._durations = []
+
+    def __len__(self):
+        return len(self._durations)
+
+    def record(self, duration):
+        """ Add the duration of an answered query
+        """
+        if len(self._durations) < self.window:
+            self._durations.append(duration)
+        else:
+            self._durations[self.count % self.window] = duration
+        self.count += 1
+
+    def percentile(self, fraction):
+        """ Duration that `fraction` of the recorded queries took at most, or
+        0.0 before any query was recorded
+        """
+        if not self._durations:
+            return 0.0
+        durations = sorted(self._durations)
+        return durations[min(len(durations) - 1, int(fraction * len(durations)))]
+
+    def debounce(self):
+        """ Debounce in seconds for the measured p95 query time
+        """
+        p95 = self.percentile(0.95)
+        if p95 < FAST_QUERY:
+            return 0.0
+        return min(MAX_DEBOUNCE, p95 * DEBOUNCE_FACTOR)
+
+
+def parse_debounce(value):
+    """ Parse the `query_debounce` preference: a number of seconds, or None
+    for "auto" and anything that is not a number, to adapt to the measured
+    query time
+    """
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,51 @@
+"""
+Least recently used cache of the rendered results of recent queries.
+"""
+from collections import OrderedDict
+
+
+class ResultCache(object):
+    """ Maps a query to its finished result list. Bounded both by the number of
+    entries and by their approximate size in bytes, as given by the caller;
+    the least recently used entries are evicted first.
+    """
+
+    def __init__(self, max_entries=128, max_bytes=1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """ Cached value for `key`, or None
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, value, size):
+        """ Cache `value`, which takes about `size` bytes, for `key`
+        """
+        if key in self._entries:
+            self.size -= self._entries.pop(key)[1]
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (value, size)
+        self.size += size
+        while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+            self.size -= self._entries.popitem(last=False)[1][1]
+
+    def clear(self):
+        """ Drop every entry, e.g. because the table they were built from changed
+        """
+        self._entries.clear()
+        self.size = 0
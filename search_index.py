@@ -0,0 +1,670 @@
+"""
+Indexes that narrow a query down to a few candidate rows before the fuzzy
+scoring of `matcher.top_matches` runs on them: whole and partial words
+of names and comments, and trigrams of the search keys. Rows found by their
+words are ranked by the BM25 weights of those words instead, and fuzzy
+scoring only runs when no row has them. A single word that only appears in
+the middle of words is matched as a substring of those and nothing else.
+
+The indexes are built together with the rest of the snapshot by
+`character_table.pack_table` and are read from the snapshot sections like
+the table columns.
+"""
+import re
+import sys
+import math
+import heapq
+import unicodedata
+from array import array
+from bisect import bisect_left
+
+# Sorts after every other character, used to find the end of a prefix range
+_LAST_CHARACTER = chr(sys.maxunicode)
+
+# BM25 parameters: saturation of the term frequency, and how much longer
+# names weigh their words down
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Notations that unambiguously denote a code point, with the base of their digits
+CODE_POINT_NOTATIONS = [
+    (re.compile(r"^[uU]\+([0-9a-fA-F]{1,6})$"), 16),  # U+2603
+    (re.compile(r"^0[xX]([0-9a-fA-F]{1,6})$"), 16),  # 0x2603
+    (re.compile(r"^\\u\{([0-9a-fA-F]{1,6})\}$"), 16),  # \u{1F600}
+    (re.compile(r"^\\u([0-9a-fA-F]{4})$"), 16),  # \u2603
+    (re.compile(r"^\\U([0-9a-fA-F]{8})$"), 16),  # \U0001F600
+    (re.compile(r"^&#([0-9]{1,7});?$"), 10),  # &#9731;
+    (re.compile(r"^&#[xX]([0-9a-fA-F]{1,6});?$"), 16),  # &#x2603;
+]
+# A bare code as shown in the results. It needs a digit so words like "face" stay words.
+BARE_CODE_POINT = re.compile(r"^(?=.*[0-9])[0-9a-fA-F]{4,6}$")
+
+
+# What people call some diacritics, by their name in character names. A query
+# word that is an alias matches the rows with either word.
+DIACRITIC_ALIASES = {
+    "umlaut": "diaeresis",
+    "dieresis": "diaeresis",
+    "trema": "diaeresis",
+    "hacek": "caron",
+    "cedille": "cedilla",
+}
+
+
+def fold(text):
+    """ `text` case folded and without diacritics, e.g. "Café" is "cafe". Search
+    keys and index terms are folded when the snapshot is built, and queries by
+    `normalize_query`, so rows are never case converted while searching.
+    """
+    if text.isascii():
+        return text.lower()
+    decomposed = unicodedata.normalize("NFKD", text)
+    return "".join(c for c in decomposed if not unicodedata.combining(c)).casefold()
+
+
+def row_terms(name, comment):
+    """ Words a row is indexed by: the folded words of its name and comment
+    """
+    return fold(" ".join([name, comment])).split()
+
+
+def query_terms(query):
+    """ Words of a query, normalized like `row_terms`
+    """
+    return normalize_query(query).split()
+
+
+# `block:arrows` or `in:"Latin Extended-A"`, anywhere in the query
+BLOCK_FILTER = re.compile(r'(?:^|\s)(?:block|in):(?:"([^"]*)"?|(\S+))', re.IGNORECASE)
+
+
+def parse_block_filter(query):
+    """ Split a `block:` or `in:` filter off a query. Returns the block name, or
+    None if the query has no filter, and the rest of the query.
+    """
+    match = BLOCK_FILTER.search(query)
+    if not match:
+        return None, query
+    name = match.group(1) if match.group(1) is not None else match.group(2)
+    return name, (query[:match.start()] + " " + query[match.end():]).strip()
+
+
+def parse_code_point(query):
+    """ Recognize a code point written in one of `CODE_POINT_NOTATIONS` or as
+    bare hex digits. Returns `(code, explicit)`, where `explicit` is False for
+    bare hex digits, or None if the query is not a code point.
+    """
+    query = query.strip()
+    for pattern, base in CODE_POINT_NOTATIONS:
+        match = pattern.match(query)
+        if match:
+            return int(match.group(1), base), True
+    if BARE_CODE_POINT.match(query):
+        return int(query, 16), False
+    return None
+
+
+def literal_code_points(query, find_code):
+    """ Code points of a query made of the characters themselves, e.g. a pasted
+    "é→™": distinct and in input order. Each is looked up with `find_code` as
+    pasted, so that e.g. OHM SIGN stays itself rather than becoming the OMEGA
+    it normalizes to. Only when that misses, or for a character followed by
+    combining marks like a decomposed "é", is the NFC form used. Returns None
+    if the query has any ASCII letters or digits of their own, which makes it
+    a search by name.
+    """
+    clusters = []
+    for character in query:
+        if clusters and unicodedata.combining(character):
+            clusters[-1] += character
+        elif not character.isspace():
+            clusters.append(character)
+    code_points = []
+    for cluster in clusters:
+        if cluster < "\x80" and cluster.isalnum():
+            return None
+        composed = unicodedata.normalize("NFC", cluster)
+        if len(cluster) == 1 and find_code(ord(cluster)) is not None:
+            codes = [ord(cluster)]
+        elif len(composed) == 1 and find_code(ord(composed)) is not None:
+            codes = [ord(composed)]
+        else:
+            codes = [ord(character) for character in cluster]
+        for code in codes:
+            if code not in code_points:
+                code_points.append(code)
+    return code_points or None
+
+
+def initials(name):
+    """ Abbreviations of a name of two words or more, made like those of HTML
+    entities: the initials of its words, and the initials of all but the last
+    word followed by the first three letters of that one. LEFT RIGHT ARROW is
+    "lra" and "lrarr", RIGHTWARDS ARROW is "ra" and "rarr".
+    """
+    words = re.findall(r"[a-z0-9]+", name.lower())
+    if len(words) < 2:
+        return []
+    head = "".join(word[0] for word in words[:-1])
+    return [head + words[-1][0], head + words[-1][:3]]
+
+
+def trigrams(text):
+    """ Set of the three character substrings of `text`
+    """
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+
+def query_trigrams(query):
+    """ Trigrams of a query, normalized like the search keys
+    """
+    return trigrams(normalize_query(query))
+
+
+def pack_postings(tags, rows_terms):
+    """ Build an inverted index over the terms of each row, given as a list
+    with one iterable of terms per row, as a list of `(tag, array or bytes)`
+    snapshot columns: the sorted terms as one blob with the offset of each, and
+    per term the ascending ids of the rows that contain it. `tags` are the
+    section tags of these four columns.
+    """
+    postings = {}
+    for row, terms in enumerate(rows_terms):
+        for term in set(terms):
+            postings.setdefault(term, []).append(row)
+    terms = sorted(postings)
+    term_offsets = array("I")
+    position = 0
+    offsets = array("I", [0])
+    rows = array("I")
+    for term in terms:
+        term_offsets.append(position)
+        position += len(term.encode("utf-8", "surrogatepass")) + 1
+        rows.extend(postings[term])
+        offsets.append(len(rows))
+    term_offsets.append(position)
+    terms_tag, term_offsets_tag, offsets_tag, rows_tag = tags
+    return [
+        (terms_tag, "\n".join(terms).encode("utf-8", "surrogatepass")),
+        (term_offsets_tag, term_offsets),
+        (offsets_tag, offsets),
+        (rows_tag, rows),
+    ]
+
+
+def pack_token_index(rows_terms):
+    """ Snapshot columns of the `TokenIndex` over `row_terms` of every row,
+    with the BM25 inverse document frequency of each term, the length norm of
+    each row, and the positions of the distinct terms of each row. Words
+    appear at most once in most names, so the frequency of a term in a row is
+    taken to be one and the norm is the whole BM25 term weight besides the IDF.
+    """
+    columns = pack_postings(TokenIndex.tags, rows_terms)
+    positions = dict((term, i) for i, term in enumerate(sorted(set().union(*rows_terms))))
+    row_offsets = array("I", [0])
+    row_positions = array("I")
+    for terms in rows_terms:
+        row_positions.extend(sorted(set(positions[term] for term in terms)))
+        row_offsets.append(len(row_positions))
+    offsets = columns[2][1]
+    count = len(rows_terms)
+    idf = array("f", [
+        math.log(1 + (count - rows + 0.5) / (rows + 0.5))
+        for rows in (end - start for start, end in zip(offsets, offsets[1:]))
+    ])
+    # Distinct words only, many comments repeat the words of the name
+    lengths = [len(set(terms)) for terms in rows_terms]
+    average = float(sum(lengths)) / len(lengths) if lengths else 1.0
+    norms = array("f", [
+        (BM25_K1 + 1) / (1 + BM25_K1 * (1 - BM25_B + BM25_B * length / average))
+        for length in lengths
+    ])
+    return columns + [
+        (b"TIDF", idf), (b"RNRM", norms), (b"RTOF", row_offsets), (b"RTRM", row_positions)
+    ]
+
+
+def pack_abbreviation_index(rows_abbreviations):
+    """ Snapshot columns of the `AbbreviationIndex`, given the abbreviations
+    of every row
+    """
+    return pack_postings(AbbreviationIndex.tags, rows_abbreviations)
+
+
+def pack_entity_index(rows_entities):
+    """ Snapshot columns of the `EntityIndex`, given the lowercased names of
+    the HTML entities of every row
+    """
+    return pack_postings(EntityIndex.tags, rows_entities)
+
+
+def pack_trigram_index(keys):
+    """ Snapshot columns of the `TrigramIndex` over the search keys of every row
+    """
+    return pack_postings(TrigramIndex.tags, [trigrams(key) for key in keys])
+
+
+def pack_key_masks(keys):
+    """ Snapshot columns of the length and the `character_mask` of every search
+    key, which `matcher.NumpyMatcher` rules rows out with
+    """
+    return [
+        (b"KLEN", array("I", [len(key) for key in keys])),
+        (b"KMSK", array("Q", [character_mask(key) for key in keys])),
+    ]
+
+
+def character_bit(character):
+    """ Bit standing for `character` in the character masks of `pack_key_masks`:
+    one each for ascii letters, digits and space, the rest share the others.
+    """
+    code = ord(character)
+    if 97 <= code <= 122:  # a-z
+        return 1 << (code - 97)
+    if 48 <= code <= 57:  # 0-9
+        return 1 << (code - 48 + 26)
+    if code == 32:
+        return 1 << 36
+    return 1 << (37 + code % 27)
+
+
+def character_mask(text):
+    mask = 0
+    for character in set(text):
+        mask |= character_bit(character)
+    return mask
+
+
+class _PackedTerms(object):
+    """ Read-only sequence of the sorted terms of a `pack_postings` blob. Terms
+    are decoded from the blob when accessed, like the names of the table, so
+    that `bisect` runs over the mapped snapshot without building a list.
+    """
+
+    def __init__(self, blob, offsets):
+        self._blob = blob
+        self._offsets = offsets
+        self._length = len(offsets) - 1
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        if not 0 <= index < self._length:
+            raise IndexError("term index out of range")
+        offsets = self._offsets
+        return str(self._blob[offsets[index]:offsets[index + 1] - 1], "utf-8", "surrogatepass")
+
+
+class PostingIndex(object):
+    """ Sorted terms with the ascending ids of the rows containing each of them,
+    read from the snapshot sections written by `pack_postings`.
+    """
+
+    tags = None
+
+    def __init__(self, sections):
+        terms_tag, term_offsets_tag, offsets_tag, rows_tag = self.tags
+        self.terms = _PackedTerms(sections[terms_tag], sections[term_offsets_tag])
+        self._offsets = sections[offsets_tag]
+        self._rows = sections[rows_tag]
+
+    def _term_rows(self, position):
+        return self._rows[self._offsets[position]:self._offsets[position + 1]]
+
+    def postings(self, term):
+        """ Ascending ids of the rows containing `term`, empty if there are none
+        """
+        position = bisect_left(self.terms, term)
+        if position == len(self.terms) or self.terms[position] != term:
+            return self._rows[0:0]
+        return self._term_rows(position)
+
+    def term_postings(self, term):
+        """ Ids of the rows a query word `term` matches, `postings` by default
+        """
+        return self.postings(term)
+
+    def intersection(self, terms):
+        """ Set of the ids of the rows containing all of `terms`, shortest postings first
+        """
+        rows = None
+        for posting in sorted((self.term_postings(term) for term in set(terms)), key=len):
+            rows = set(posting) if rows is None else rows.intersection(posting)
+            if not rows:
+                break
+        return rows if rows is not None else set()
+
+
+class TokenIndex(PostingIndex):
+    """ Inverted index from the words of names and comments to the rows
+    containing them.
+    """
+
+    tags = (b"TERM", b"TPOS", b"TOFF", b"TROW")
+
+    def __init__(self, sections):
+        super(TokenIndex, self).__init__(sections)
+        self._idf = sections[b"TIDF"]
+        self._norms = sections[b"RNRM"]
+        self._row_offsets = sections[b"RTOF"]
+        self._row_positions = sections[b"RTRM"]
+
+    def position(self, term):
+        """ Position of `term` in `terms`, or None if no row has it
+        """
+        position = bisect_left(self.terms, term)
+        if position == len(self.terms) or self.terms[position] != term:
+            return None
+        return position
+
+    def row_positions(self, row):
+        """ Ascending positions in `terms` of the words of `row`
+        """
+        return self._row_positions[self._row_offsets[row]:self._row_offsets[row + 1]]
+
+    def idf(self, term):
+        """ Inverse document frequency of `term`, 0.0 if no row has it
+        """
+        position = self.position(term)
+        return 0.0 if position is None else self._idf[position]
+
+    def term_idf(self, term):
+        """ IDF of a query word, the higher of its own and that of its alias
+        """
+        return max(self.idf(term), self.idf(DIACRITIC_ALIASES.get(term, term)))
+
+    def term_postings(self, term):
+        """ Ids of the rows with `term` or its alias in `DIACRITIC_ALIASES`
+        """
+        alias = DIACRITIC_ALIASES.get(term)
+        if alias is None:
+            return self.postings(term)
+        return sorted(set(self.postings(term)).union(self.postings(alias)))
+
+    def prefix_range(self, prefix):
+        """ Start and end position in `terms` of the words starting with `prefix`
+        """
+        start = bisect_left(self.terms, prefix)
+        return start, bisect_left(self.terms, prefix + _LAST_CHARACTER, start)
+
+    def prefix_positions(self, prefix):
+        """ Positions in `terms` of the words a word still being typed matches:
+        those starting with `prefix`, and its alias if it has one
+        """
+        start, end = self.prefix_range(prefix)
+        positions = list(range(start, end))
+        alias = self.position(DIACRITIC_ALIASES.get(prefix, ""))
+        if alias is not None and not start <= alias < end:
+            positions.append(alias)
+        return positions
+
+    def prefix_postings(self, prefix):
+        """ Ascending ids of the rows containing a word that `prefix` matches,
+        merged lazily from the postings of those words.
+        """
+        last = None
+        for row in heapq.merge(*[self._term_rows(i) for i in self.prefix_positions(prefix)]):
+            if row != last:
+                last = row
+                yield row
+
+    def candidates(self, terms):
+        """ Ascending ids of the rows containing all of `terms`, or None when
+        there are no terms to narrow the search with. The last term is taken
+        to be the word still being typed and matches every word it starts.
+        """
+        if not terms:
+            return None
+        if len(terms) == 1:
+            return list(self.prefix_postings(terms[0]))
+        rows = self.intersection(terms[:-1])
+        if not rows:
+            return []
+        matches = set()
+        for position in self.prefix_positions(terms[-1]):
+            matches.update(rows.intersection(self._term_rows(position)))
+        return sorted(matches)
+
+    def rank(self, rows, terms, limit=10):
+        """ The at most `limit` of `rows` with the highest BM25 score
+        for `terms`, best first and in row order among equal scores. `rows` are
+        expected to contain every term, like the `candidates` of `terms`.
+
+        The score is the sum of the IDF of the terms times the length norm of
+        the row. The last term is a prefix, which weighs as much as the most
+        common word it starts times the share of the word it starts in the
+        row typed so far, so that "arro" ranks ARROW above the rarer ARROWS.
+        The alias of a word weighs as much as a word typed in full.
+        """
+        if not terms:
+            return []
+        complete = sum(self.term_idf(term) for term in terms[:-1])
+        prefix = terms[-1]
+        positions = self.prefix_positions(prefix)
+        if not positions:
+            return []
+        prefix_idf = min(self._idf[position] for position in positions)
+        # Weight of each word the prefix matches, by its position in `terms`
+        weights = {}
+        for position in positions:
+            word = self.terms[position]
+            if word.startswith(prefix):
+                weights[position] = prefix_idf * len(prefix) / len(word)
+            else:
+                weights[position] = prefix_idf
+        # Weight of the prefix in each row: from the postings of the words it
+        # matches when they are few, else from the words of each row
+        postings = sum(self._offsets[i + 1] - self._offsets[i] for i in positions)
+        if postings <= 4 * len(rows):
+            prefix_weights = dict.fromkeys(rows, 0.0)
+            for position in positions:
+                weight = weights[position]
+                for row in self._term_rows(position):
+                    if prefix_weights.get(row, weight) < weight:
+                        prefix_weights[row] = weight
+        else:
+            get = weights.get
+            prefix_weights = {}
+            for row in rows:
+                prefix_weights[row] = max(
+                    [get(position, 0.0) for position in self.row_positions(row)]
+                )
+        norms = self._norms
+        # Later rows lose ties, hence the negated row id
+        scored = [
+            (norms[row] * (complete + weight), -row) for row, weight in prefix_weights.items()
+        ]
+        return [-row for score, row in heapq.nlargest(limit, scored)]
+
+
+class EntityIndex(PostingIndex):
+    """ Index from the lowercased names of the single character HTML5 entities
+    to the rows of their characters, for queries like "rarr", "gt" or "copy".
+    """
+
+    tags = (b"ENTY", b"EPOS", b"EOFF", b"EROW")
+
+    def candidates(self, query):
+        """ Ascending ids of the rows of the entity `query` names, also written
+        like "&rarr;", or an empty list if the query is not a single word
+        """
+        terms = query_terms(query)
+        if len(terms) != 1:
+            return []
+        return list(self.postings(terms[0].lstrip("&").rstrip(";")))
+
+
+class AbbreviationIndex(PostingIndex):
+    """ Index from the `initials` of names to the rows they abbreviate, for
+    queries like "lra" or "lrarr" that are no word of any name.
+    """
+
+    tags = (b"ABBR", b"APOS", b"AOFF", b"AROW")
+
+    def candidates(self, table, query):
+        """ Rows that `query` abbreviates, shortest search key first, or None
+        if the query is not a single word or starts a word of a name, in which
+        case the `TokenIndex` finds it.
+        """
+        terms = query_terms(query)
+        if len(terms) != 1:
+            return None
+        start, end = table.token_index.prefix_range(terms[0])
+        if start != end:
+            return None
+        keys = table.search_keys
+        return sorted(self.postings(terms[0]), key=lambda row: (len(keys[row]), row))
+
+
+class TrigramIndex(PostingIndex):
+    """ Index from the trigrams of the search keys to the rows containing them,
+    to find rows where the query appears in the middle of a word.
+    """
+
+    tags = (b"GRAM", b"GPOS", b"GOFF", b"GROW")
+
+    def candidates(self, query):
+        """ Ascending ids of the rows whose search key contains every trigram of
+        `query`, or None if the query is too short to have any.
+        """
+        grams = query_trigrams(query)
+        if not grams:
+            return None
+        return sorted(self.intersection(grams))
+
+
+def normalize_query(query):
+    """ Query folded and with whitespace collapsed like the search keys
+    """
+    return " ".join(fold(query).split())
+
+
+def _token_candidates(table, query):
+    return table.token_index.candidates(query_terms(query))
+
+
+def _refine_token_candidates(table, query, rows):
+    """ Rows out of `rows` that have the words of `query`, the last one as a
+    prefix, like `TokenIndex.candidates` finds them. Compares the positions of
+    the words in the `TokenIndex`, so no row is decoded or case converted.
+    """
+    index = table.token_index
+    terms = query_terms(query)
+    words = []
+    for term in terms[:-1]:
+        alternatives = set([term, DIACRITIC_ALIASES.get(term, term)])
+        words.append(set(index.position(word) for word in alternatives) - set([None]))
+    start, end = index.prefix_range(terms[-1])
+    alias = index.position(DIACRITIC_ALIASES.get(terms[-1], ""))
+    matches = []
+    for row in rows:
+        positions = index.row_positions(row)
+        if all(not alternatives.isdisjoint(positions) for alternatives in words) and any(
+            start <= position < end or position == alias for position in positions
+        ):
+            matches.append(row)
+    return matches
+
+
+def _trigram_candidates(table, query):
+    return table.trigram_index.candidates(query)
+
+
+def _refine_trigram_candidates(table, query, rows):
+    """ Rows out of `rows` whose search key contains every trigram of `query`
+    """
+    grams = query_trigrams(query)
+    keys = table.search_keys
+    return [row for row in rows if all(gram in keys[row] for gram in grams)]
+
+
+# Ways of narrowing a query down, from the narrowest to the widest: from an
+# index, and by filtering the candidates of a query that the new one extends
+CANDIDATE_STAGES = [
+    (_token_candidates, _refine_token_candidates),
+    (_trigram_candidates, _refine_trigram_candidates),
+]
+
+# Index in `CANDIDATE_STAGES` of the rows that have the words of the query.
+# Those are ranked by `TokenIndex.rank`, the other stages by fuzzy scoring.
+TOKEN_STAGE = 0
+
+# Index in `CANDIDATE_STAGES` of the rows that have the trigrams of the query.
+# Fuzzy scoring never rates a word in the middle of another one high enough,
+# so when none of them pass, the rows that have a single word query as a
+# substring are ranked without a threshold and the rest of the table is not
+# scanned for it.
+TRIGRAM_STAGE = 1
+
+# Filtering the candidates of the previous query costs a regular expression or
+# substring test per row, while the indexes answer in about a millisecond at
+# any size, so only small candidate sets are filtered
+REFINE_LIMIT = 256
+
+_NOT_COMPUTED = object()
+
+
+class _QueryState(object):
+    """ Candidate rows of one query at each stage, computed on demand
+    """
+
+    def __init__(self, query, parent):
+        self.query = query
+        self.parent = parent
+        self.stages = [_NOT_COMPUTED] * len(CANDIDATE_STAGES)
+
+    def candidates(self, table, stage):
+        if self.stages[stage] is _NOT_COMPUTED:
+            from_index, refine = CANDIDATE_STAGES[stage]
+            parent_rows = None
+            if self.parent is not None:
+                parent_rows = self.parent.candidates(table, stage)
+            # A query's candidates at a stage are a subset of those of any
+            # query it extends, so those are enough to filter from. That does
+            # not hold once the word being typed becomes an alias.
+            if (
+                parent_rows is None or len(parent_rows) > REFINE_LIMIT
+                or self.query.rsplit(" ", 1)[-1] in DIACRITIC_ALIASES
+            ):
+                self.stages[stage] = from_index(table, self.query)
+            else:
+                self.stages[stage] = refine(table, self.query, parent_rows)
+        return self.stages[stage]
+
+
+class QueryRefiner(object):
+    """ Keeps the candidate rows of the last queries, as typed one keystroke
+    after the other. A query that extends the previous one only filters the
+    rows that were still candidates for it, and backspacing goes back to the
+    state of the shorter query.
+    """
+
+    def __init__(self, depth=32):
+        self.depth = depth
+        self._table = None
+        self._states = []
+
+    def candidate_rows(self, table, query):
+        """ Yield the candidate rows of `table` for `query` for each stage from
+        the narrowest to the widest: rows containing its words, then rows
+        containing its trigrams. Each is an ascending list of row ids, or None
+        when the stage cannot narrow this query down. The caller moves on to
+        the next one while scoring finds nothing, and scans the whole table
+        once they are exhausted.
+        """
+        if table is not self._table:
+            self._table = table
+            self._states = []
+        query = normalize_query(query)
+        states = self._states
+        while states and not query.startswith(states[-1].query):
+            states.pop()
+        if not states or states[-1].query != query:
+            states.append(_QueryState(query, states[-1] if states else None))
+            if len(states) > self.depth:
+                del states[0]
+                states[0].parent = None
+        state = states[-1]
+        for stage in range(len(CANDIDATE_STAGES)):
+            yield state.candidates(table, stage)
@@ -0,0 +1,106 @@
+"""
+Persistent counts of the characters copied from the results, decaying over
+time so that what was picked recently outweighs what was picked long ago.
+"""
+import os
+import time
+import struct
+import logging
+
+logger = logging.getLogger(__name__)
+
+USAGE_FILE = "usage.bin"
+
+# Folder of this extension in the user's data directory. Ulauncher replaces the
+# extension directory when it is reinstalled, so the counts are kept outside it.
+DATA_FOLDER = "ulauncher-symbol"
+
+# Code point, decayed count, and the time in seconds the count was last updated
+_ENTRY = struct.Struct("<Idd")
+
+# A count halves every this many seconds
+HALF_LIFE = 30 * 24 * 3600.0
+
+
+def usage_path():
+    """ Path of the usage store under `$XDG_DATA_HOME`, by default `~/.local/share`
+    """
+    data_home = os.environ.get("XDG_DATA_HOME") or os.path.join(
+        os.path.expanduser("~"), ".local", "share"
+    )
+    return os.path.join(data_home, DATA_FOLDER, USAGE_FILE)
+
+
+class UsageStore(object):
+    """ Decayed selection counts by code point, saved to `path` after every
+    change. Only the `max_entries` highest counts are kept, and the
+    `hot_size` highest of those make up the hot set, best first.
+    """
+
+    def __init__(self, path, max_entries=1024, hot_size=64, half_life=HALF_LIFE):
+        self.path = path
+        self.max_entries = max_entries
+        self.hot_size = hot_size
+        self.half_life = half_life
+        self._counts = {}
+        self.hot_codes = []
+
+    def load(self):
+        """ Read the counts saved at `path`, if any
+        """
+        try:
+            with open(self.path, "rb") as source:
+                data = source.read()
+        except (IOError, OSError):
+            return
+        entries = _ENTRY.iter_unpack(data[:len(data) - len(data) % _ENTRY.size])
+        self._counts = dict((code, (count, updated)) for code, count, updated in entries)
+        self._update_hot_codes()
+
+    def save(self):
+        """ Write the counts to `path`, replacing the file atomically
+        """
+        temp_path = "%s.%d.tmp" % (self.path, os.getpid())
+        try:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(temp_path, "wb") as target:
+                for code, (count, updated) in self._counts.items():
+                    target.write(_ENTRY.pack(code, count, updated))
+            os.rename(temp_path, self.path)
+        except (IOError, OSError) as e:
+            logger.warning("Could not save the usage counts: %s", e)
+
+    def count(self, code, now=None):
+        """ Count of `code` decayed to `now`
+        """
+        entry = self._counts.get(code)
+        if entry is None:
+            return 0.0
+        count, updated = entry
+        if now is None:
+            now = time.time()
+        return count * 0.5 ** (max(0.0, now - updated) / self.half_life)
+
+    def record(self, code, now=None):
+        """ Count one selection of `code` and save the store
+        """
+        if now is None:
+            now = time.time()
+        self._counts[code] = (self.count(code, now) + 1.0, now)
+        if len(self._counts) > self.max_entries:
+            for dropped in self._ranked(now)[self.max_entries:]:
+                del self._counts[dropped]
+        self._update_hot_codes(now)
+        self.save()
+
+    def _ranked(self, now):
+        """ Codes by decayed count, highest first, in code order among equal counts
+        """
+        return sorted(self._counts, key=lambda code: (-self.count(code, now), code))
+
+    def _update_hot_codes(self, now=None):
+        if now is None:
+            now = time.time()
+        self.hot_codes = self._ranked(now)[:self.hot_size]